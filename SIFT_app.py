@@ -12,7 +12,59 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 from python_qt_binding import loadUi
 import cv2
 import sys
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+## Webcam capture on a background thread
+#
+#  Class continuously reads frames from an Open CV camera device and keeps the most recent one,
+#  so that the user interface timer never blocks waiting for the camera driver.
+class Camera_Thread(QtCore.QThread):
+
+
+    ## The constructor stores the camera device that frames are read from
+    #  @param self the object pointer
+    #  @param camera_device an open cv VideoCapture object
+    #  @param parent the parent Qt object
+    def __init__(self, camera_device, parent=None):
+        super(Camera_Thread, self).__init__(parent)
+        self._camera_device = camera_device
+        self._lock = threading.Lock()
+        self._latest_frame = None
+        self._is_running = False
+
+    ## The run function reads frames until stop is called, replacing the latest frame each time
+    #  @param self the object pointer
+    def run(self):
+        while self._is_running:
+            ret, frame = self._camera_device.read()
+            if not ret:
+                self.msleep(10)
+                continue
+            with self._lock:
+                self._latest_frame = frame
+
+    ## The start_capture function starts reading frames on the background thread
+    #  @param self the object pointer
+    def start_capture(self):
+        self._is_running = True
+        self.start()
+
+    ## The stop_capture function stops reading frames and waits for the thread to finish
+    #  @param self the object pointer
+    def stop_capture(self):
+        self._is_running = False
+        self.wait()
+
+    ## The latest_frame function returns a copy of the most recent frame, or None if no frame has been read yet
+    #  @param self the object pointer
+    def latest_frame(self):
+        with self._lock:
+            frame = self._latest_frame
+        if frame is None:
+            return None
+        return frame.copy()
 
 ## Object identification using the webcam (requires a User Interface)
 #  
@@ -38,6 +90,37 @@ class My_App(QtWidgets.QMainWindow):
         self._is_cam_enabled = False
         self._is_template_loaded = False
 
+        # Factor the webcam frame is downscaled by (with pyrDown, so a power of 2) before SIFT, 1 disables it
+        self._detect_scale = 2
+
+        # The last homography is reused while the mean absolute difference to the frame it was computed on stays under the threshold
+        self._motion_thresh = 3.0
+        self._prev_gray = None
+        self._prev_matrix = None
+
+        # Buffers for the transformed template corners and the integer points of the homography box
+        self._corners_buf = np.empty((4, 1, 2), np.float32)
+        self._poly_buf = np.empty((4, 1, 2), np.int32)
+
+        # Create the SIFT detector once and reuse it for every webcam frame
+        # nfeatures keeps only the strongest keypoints, which bounds the cost of the FLANN matching
+        # SIFT stays on the CPU: OpenCV has no CUDA SIFT, and a binary detector such as cv2.cuda ORB would not work with the kd-tree matcher
+        # pycolmap's GPU SIFT is not used either, it needs a CUDA build of COLMAP and does not return the cv2 keypoints drawMatches needs
+        self._sift = cv2.xfeatures2d.SIFT_create(nfeatures = 500)
+
+        # When a new template is chosen, its features are computed on a worker thread while the webcam frame is processed
+        # Open CV releases the GIL, so both run in parallel; the template uses its own detector to avoid sharing one between threads
+        self._templ_sift = cv2.xfeatures2d.SIFT_create(nfeatures = 500)
+        self._executor = ThreadPoolExecutor(max_workers = 1)
+        self._is_template_changed = False
+
+        # FLANN matcher (kd-tree) that is trained on the template descriptors in load_template_features
+        # checks = 32 is Open CV's default number of leaves searched per query, the 0.65 ratio threshold is tuned with it
+        # An LSH index is not used: it compares binary descriptors with the Hamming distance, which does not apply to SIFT
+        index_params = dict(algorithm = 1, trees = 5)
+        search_params = dict(checks = 32)
+        self._flann = cv2.FlannBasedMatcher(index_params, search_params)
+
         # Connect pushbuttons to processes (image choice and webcam)
         self.browse_button.clicked.connect(self.SLOT_browse_button)
         self.toggle_cam_button.clicked.connect(self.SLOT_toggle_camera)
@@ -47,119 +130,274 @@ class My_App(QtWidgets.QMainWindow):
         self._camera_device.set(3, 320)
         self._camera_device.set(4, 240)
 
+        # Read the webcam on a background thread so the timer only picks up the latest frame
+        self._camera_thread = Camera_Thread(self._camera_device, self)
+
+        # Output buffers reused by the grayscale and pixmap (for older Qt versions) color conversions of every frame
+        # Open CV reallocates them if an image of a different size is converted
+        self._gray_buf = np.empty((240, 320), np.uint8)
+        self._rgb_buf = np.empty((240, 320, 3), np.uint8)
+
+        # Qt 5.14 and newer can display BGR images directly, which skips the pixmap color conversion
+        self._has_bgr888 = hasattr(QtGui.QImage, "Format_BGR888")
+
         # Timer used to trigger the camera
         self._timer = QtCore.QTimer(self)
         self._timer.timeout.connect(self.SLOT_query_camera)
-        self._timer.setInterval(100 / self._cam_fps)
+        # The interval is in milliseconds, a coarse timer is precise enough at the camera frame rate
+        self._timer.setTimerType(QtCore.Qt.CoarseTimer)
+        self._timer.setInterval(int(1000 / self._cam_fps))
 
     ##  The convert_cv_to_pixmap converts an open CV image to a Pixmap format
+    #   The BGR image is used as is when Qt supports the BGR888 format, otherwise it is converted to RGB first
     #   As a result, a pixmap image is returned, which can then be displayed in the user interface
     #   @param self the onject pointer
     #   @param cv_img an open cv image
     def convert_cv_to_pixmap(self, cv_img):
-        cv_img = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
+        if self._has_bgr888:
+            img_format = QtGui.QImage.Format_BGR888
+        else:
+            cv_img = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB, dst=self._rgb_buf)
+            img_format = QtGui.QImage.Format_RGB888
         height, width, channel = cv_img.shape
         bytesPerLine = channel * width
         q_img = QtGui.QImage(cv_img.data, width, height, 
-                     bytesPerLine, QtGui.QImage.Format_RGB888)
+                     bytesPerLine, img_format)
         return QtGui.QPixmap.fromImage(q_img)
 
 
-    ##  The SLOT_query_function intializes the webcam frame and the template image chosen.
-    #   It then applies the SIFT algortihm to the template image and the webcam image
+    ##  The ratio_filter applies the ratio test to the k=2 matches of the webcam descriptors
+    #   The distances and indices of all matches are read into one NumPy array in a single pass,
+    #   then the matches whose best distance is under the ratio times the second best distance are selected with a mask
+    #   @param self the onject pointer
+    #   @param matches the (m, n) matches returned by knnMatch
+    #   @param ratio the ratio test threshold
+    #   @return the boolean mask of the selected matches, and their webcam and template keypoint indices
+    def ratio_filter(self, matches, ratio):
+        match_data = np.array([(m.distance, n.distance, m.queryIdx, m.trainIdx) for m, n in matches],
+                              dtype=np.float32).reshape(-1, 4)
+        is_poi = match_data[:,0] < ratio*match_data[:,1]
+        frame_idx = match_data[is_poi,2].astype(np.intp)
+        templ_idx = match_data[is_poi,3].astype(np.intp)
+        return is_poi, frame_idx, templ_idx
+
+
+    ##  The display_homography draws the template outline mapped by a homography onto the webcam image and displays it
+    #   @param self the onject pointer
+    #   @param frame the open cv webcam image
+    #   @param matrix the homography from the template image to the webcam image
+    def display_homography(self, frame, matrix):
+
+        # Use a perspective transform to map the precomputed template corners to the webcame image - this accounts for depth 
+        dst = cv2.perspectiveTransform(self._templ_corners, matrix, dst=self._corners_buf)
+
+        # Create the homography box using the polylines function, the corners are truncated to integers in the preallocated buffer
+        np.copyto(self._poly_buf, dst, casting="unsafe")
+        homography = cv2.polylines(frame, [self._poly_buf], True, (255, 0, 0), 3)
+
+        pixmap = self.convert_cv_to_pixmap(homography)
+        self.live_image_label.setPixmap(pixmap)
+
+
+    ##  The SLOT_query_function intializes the webcam frame and uses the cached template features (computed by load_template_features).
+    #   It then applies the SIFT algortihm to the webcam image
     #   in order to determine the keypoints and the descriptors.
-    #   Then it draws the keypoints onto the images. The function then computes an optimized
-    #   form of the kth nearest neighbors algorithm on the descriptors.
+    #   The function then queries the FLANN index
+    #   trained on the template descriptors using the kth nearest neighbors algorithm.
     #   A threshold a set to determine points that have very similar descriptors (small distance).
     #   If there are enough mathching points, a homography will be formed using the homography, perspective transform,
-    #   and polylines functions. If there are not enough matches, the webcam and template images will be displayed with lines between matching points
+    #   and polylines functions. While the webcam image stays nearly unchanged, the last homography is displayed without running SIFT.
+    #   If there are not enough matches, the webcam and template images will be displayed with their keypoints and lines between matching points
     #   @param self the onject pointer
     def SLOT_query_camera(self):
         
-        # Initialize grayscaled webcam frame and template image
-        ret, frame = self._camera_device.read()
-        grayframe = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        img_templ = cv2.imread(self.template_path,cv2.IMREAD_GRAYSCALE)
-
-        # Conduct SIFt algorithm on the template image and the webcam image, then draw the keypoints on both images
-        sift = cv2.xfeatures2d.SIFT_create()
-        keyp_img_templ, desc_img_templ = sift.detectAndCompute(img_templ, None)
-        keyp_gframe, desc_gframe = sift.detectAndCompute(grayframe, None)
-        img_templ = cv2.drawKeypoints(img_templ, keyp_img_templ, img_templ)
-        grayframe = cv2.drawKeypoints(grayframe, keyp_gframe, grayframe)
-
-        # Setup and conduct k-nearest Neighbor algorithm on the descriptors of each image using the FLANN library for quick computation
-        index_params = dict(algorithm = 0, trees = 5)
-        search_params = dict()
-        flann  = cv2.FlannBasedMatcher(index_params, search_params)
-        matches = flann.knnMatch(desc_img_templ, desc_gframe, k=2)
+        # A template has to be chosen with SLOT_browse_button first
+        if not self._is_template_loaded:
+            return
+
+        # Initialize grayscaled webcam frame, the template image and its keypoints are cached
+        # The frame stays a NumPy array rather than a cv2.UMat: SIFT runs on the CPU, so OpenCL would only add transfers
+        frame = self._camera_thread.latest_frame()
+        if frame is None:
+            return
+        grayframe = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray_buf)
+
+        # Skip SIFT and reuse the last homography if the webcam image barely changed since it was computed
+        # Comparing against that frame (and not the previous one) lets slow motion add up until the homography is recomputed
+        prev_gray = self._prev_gray
+        if self._prev_matrix is not None and prev_gray.shape == grayframe.shape:
+            diff_mean = cv2.norm(prev_gray, grayframe, cv2.NORM_L1) / grayframe.size
+            if diff_mean < self._motion_thresh:
+                self.display_homography(frame, self._prev_matrix)
+                return
+
+        # Downscale the webcam image to reduce the SIFT work, the keypoints are scaled back for the homography
+        detectframe = grayframe
+        scale = 1
+        while scale < self._detect_scale:
+            detectframe = cv2.pyrDown(detectframe)
+            scale *= 2
+
+        # If the template changed, compute its features on the worker thread while SIFT runs on the webcam image
+        templ_future = None
+        if self._is_template_changed:
+            templ_future = self._executor.submit(self.load_template_features)
+
+        # Conduct SIFt algorithm on the webcam image
+        keyp_gframe, desc_gframe = self._sift.detectAndCompute(detectframe, None)
+
+        # The template features and the FLANN index are cached after the first frame
+        # The template only counts as processed once load_template_features succeeded, otherwise it is retried on the next frame
+        # The error is not raised further, since an exception in a Qt slot aborts the application
+        if templ_future is not None:
+            try:
+                templ_future.result()
+            except Exception as error:
+                print("Could not compute the template features: " + str(error))
+                return
+            self._is_template_changed = False
+        keyp_img_templ = self._keyp_templ
+
+        # Conduct k-nearest Neighbor algorithm on the webcam descriptors using the FLANN index trained on the template
+        # The webcam descriptors are the queries, so queryIdx refers to the webcam keypoints and trainIdx to the template keypoints
+        # There is nothing to match if the template has fewer than 2 descriptors or the webcam image (e.g. a covered lens) has none
+        if self._desc_templ is None or desc_gframe is None:
+            matches = []
+        else:
+            matches = self._flann.knnMatch(desc_gframe, k=2)
 
         # Select the matches that are the most similar (distances are under a threshold)
         # The threshold is set by the 0.65 multiplying the n distance. Increasing the 0.65 leads to increased matching and false positives
-        poi =  []
-        for m, n in matches:
-            if m.distance < 0.65*n.distance:
-                poi.append(m)
+        is_poi, frame_idx, templ_idx = self.ratio_filter(matches, 0.65)
 
         # If there are enough matches, then create the homography, otherwise displays the two images with lines between the matches
         # The number 4 can be increased to for more rigidity in homography detection
-        if len(poi) > 4:
+        if len(frame_idx) > 4:
 
             # Use the keypoints to create a mapping of the image using the homography function with RANSAC algorithm
-            query_pts = np.float32([keyp_img_templ[m.queryIdx].pt for m in poi]).reshape(-1,1,2)
-            train_pts = np.float32([keyp_gframe[m.trainIdx].pt for m in poi]).reshape(-1,1,2)
-            matrix, mask = cv2.findHomography(query_pts, train_pts, cv2.RANSAC, 5.0)
+            # The points are gathered by indexing contiguous arrays of keypoint coordinates
+            frame_xy = np.array([kp.pt for kp in keyp_gframe], dtype=np.float32)*scale
+            templ_pts = self._templ_xy[templ_idx].reshape(-1,1,2)
+            frame_pts = frame_xy[frame_idx].reshape(-1,1,2)
+            matrix, mask = cv2.findHomography(templ_pts, frame_pts, cv2.RANSAC, 5.0)
             matches_mask = mask.ravel().tolist()
 
-            # Use a perspective transform to map the contours to the webcame image - this accounts for depth 
-            h, w, c = img_templ.shape
-            pts = np.float32([[0,0], [0, h], [w,h], [w,0]]).reshape(-1, 1, 2)
-            dst = cv2.perspectiveTransform(pts, matrix)
-
-            # Create the homography box using the polylines function
-            homography = cv2.polylines(frame, [np.int32(dst)], True, (255, 0, 0), 3)
+            # Keep the homography and the frame it was computed on, the grayscale buffers are swapped so the next frame does not overwrite it
+            self._prev_matrix = matrix
+            self._gray_buf = prev_gray
+            self._prev_gray = grayframe
 
             #Display the Homography
-            pixmap = self.convert_cv_to_pixmap(homography)
-            self.live_image_label.setPixmap(pixmap)
+            self.display_homography(frame, matrix)
         else:
+            self._prev_matrix = None
+
+            # The DMatch objects are only needed to draw the matches
+            poi = [m for (m, n), keep in zip(matches, is_poi) if keep]
+
+            # The webcam keypoints were detected on the downscaled image, scale them back up to draw them on the full size frame
+            if scale > 1:
+                keyp_gframe = [cv2.KeyPoint(kp.pt[0]*scale, kp.pt[1]*scale, kp.size*scale, kp.angle, kp.response, kp.octave, kp.class_id)
+                               for kp in keyp_gframe]
+
+            # Draw the keypoints on both images only here, since they are not shown with the homography
+            img_templ = cv2.drawKeypoints(self._img_templ, keyp_img_templ, None)
+            grayframe = cv2.drawKeypoints(grayframe, keyp_gframe, None)
+
             # Display the mathcing points
-            match_img = cv2.drawMatches(img_templ, keyp_img_templ, grayframe, keyp_gframe, poi, grayframe)
+            match_img = cv2.drawMatches(grayframe, keyp_gframe, img_templ, keyp_img_templ, poi, None)
             pixmap = self.convert_cv_to_pixmap(match_img)
             self.live_image_label.setPixmap(pixmap)
-
             
+    ## The load_template_features function computes the template keypoints and descriptors
+    #  and trains the FLANN index on them. It is called once per template by SLOT_query_camera,
+    #  on the worker thread, so that it does not repeat this work every frame
+    #  @param self the onject pointer
+    def load_template_features(self):
+
+        # Compute the template keypoints and descriptors once, since the template does not change between frames
+        # They are only stored once all of them are computed, so the cached features always belong to the same template
+        keyp_templ, desc_templ = self._templ_sift.detectAndCompute(self._img_templ, None)
+        templ_xy = np.array([kp.pt for kp in keyp_templ], dtype=np.float32).reshape(-1, 2)
+
+        # Keep the descriptors as one contiguous float32 array so FLANN indexes the same buffer for every frame
+        # knnMatch with k=2 needs at least 2 template descriptors, a template with fewer (e.g. a plain color image)
+        # leaves the FLANN index untrained and never matches
+        if desc_templ is not None and len(desc_templ) < 2:
+            desc_templ = None
+        if desc_templ is not None:
+            desc_templ = np.ascontiguousarray(desc_templ, dtype=np.float32)
+
+        # Train the FLANN index on the template descriptors once, so that each frame only queries it
+        self._flann.clear()
+        if desc_templ is not None:
+            self._flann.add([desc_templ])
+            self._flann.train()
+
+        self._keyp_templ = keyp_templ
+        self._desc_templ = desc_templ
+        self._templ_xy = templ_xy
+
     ## The SLOT_browse_button function opens a dialogue when the pushbutton is pressed.
     #  This dialogue enables the user to choose an image. Using the path of the image, the 
     #  function intakes the image, converts it to a pixmap format and then displays the picture in the
-    #  user interface
+    #  user interface. The template features are then computed by load_template_features on the next camera frame
     #  @param self the onject pointer
     def SLOT_browse_button(self):
         dlg = QtWidgets.QFileDialog()
         dlg.setFileMode(QtWidgets.QFileDialog.ExistingFile)
         
-        # Intake path of image selected by user
-        if dlg.exec_():
-            self.template_path = dlg.selectedFiles()[0]
+        # Intake path of image selected by user, the current template is kept if the dialogue is cancelled
+        if not dlg.exec_():
+            return
+        template_path = dlg.selectedFiles()[0]
+
+        # Load the template once, its features are computed alongside the next camera frame
+        img_templ = cv2.imread(template_path, cv2.IMREAD_GRAYSCALE)
+        if img_templ is None:
+            print("Could not read template image file: " + template_path)
+            return
+        self.template_path = template_path
+        self._img_templ = img_templ
+        self._is_template_changed = True
 
         # Convert to pixmap and display image in user interface
         pixmap = QtGui.QPixmap(self.template_path)
         self.template_label.setPixmap(pixmap)
         print("Loaded template image file: " + self.template_path)
 
+        # Template corners used to draw the homography box
+        h, w = self._img_templ.shape
+        self._templ_corners = np.float32([[0,0], [0, h], [w,h], [w,0]]).reshape(-1, 1, 2)
+        self._prev_matrix = None
+        self._is_template_loaded = True
+
     ## The SLOT_toggle_camera starts and stops the timer for camera feed intake
+    #  along with the background thread reading the webcam.
     #  It also checks the pushbutton to see if has been switched to Enabled or Disabled
     #  @param self the onject pointer
     def SLOT_toggle_camera(self):
         if self._is_cam_enabled:
             self._timer.stop()
+            self._camera_thread.stop_capture()
             self._is_cam_enabled = False
             self.toggle_cam_button.setText("&Enable camera")
         else:
+            self._camera_thread.start_capture()
             self._timer.start()
             self._is_cam_enabled = True
             self.toggle_cam_button.setText("&Disable camera")
 
+    ## The closeEvent function stops the camera thread and the worker thread before the window is closed
+    #  @param self the onject pointer
+    #  @param event the Qt close event
+    def closeEvent(self, event):
+        if self._is_cam_enabled:
+            self._timer.stop()
+            self._camera_thread.stop_capture()
+        self._executor.shutdown()
+        super(My_App, self).closeEvent(event)
+
 
 # Setup a myApp object and execute myApp along with user interface when invoked
 if __name__ == "__main__":